@@ -1,29 +1,166 @@
+import functools
+import hashlib
+import http.client
 import logging
+import shelve
+import shutil
+import threading
+import urllib.error
 import urllib.request
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import googlemaps
-from plotly.offline import iplot
-from plotly.graph_objs import Scattermapbox, Layout, Figure
+from flask_caching import Cache
+from plotly.graph_objs import Scattermapbox, Layout
 
 # read these from env variables
 GEOCODE_API_KEY = os.environ['GEOCODE_API_KEY']
 MAPBOX_ACCESS_TOKEN = os.environ['MAPBOX_ACCESS_TOKEN']
 URL = 'https://data.cityofnewyork.us/api/views/43nn-pn8j/rows.csv?accessType=DOWNLOAD'
 ADDRESS_COLUMNS = ['DBA', 'BUILDING', 'STREET', 'BORO', 'ZIPCODE']
-
+# only the columns the app uses are read from the data set
+COLUMNS = ADDRESS_COLUMNS + ['CAMIS', 'CUISINE DESCRIPTION',
+                             'GRADE', 'GRADE DATE', 'SCORE',
+                             'Latitude', 'Longitude']
+# low cardinality columns are dictionary encoded, which pandas
+# turns into categoricals that compare much faster as integer codes
+COLUMN_TYPES = {'CAMIS': pa.int32(),
+                'ZIPCODE': pa.int32(),
+                'SCORE': pa.float32(),
+                'GRADE DATE': pa.timestamp('s'),
+                'Latitude': pa.float64(),
+                'Longitude': pa.float64(),
+                'CUISINE DESCRIPTION': pa.dictionary(pa.int32(), pa.string()),
+                'GRADE': pa.dictionary(pa.int32(), pa.string()),
+                'BORO': pa.dictionary(pa.int32(), pa.string())}
+CACHE_DIR = os.environ.get('VIZ_CACHE_DIR',
+                           os.path.expanduser('~/.cache/viz'))
+DATA_FILE = os.path.join(CACHE_DIR, 'inspections.csv')
+ETAG_FILE = DATA_FILE + '.etag'
+PARQUET_FILE = os.path.join(CACHE_DIR, 'inspections.parquet')
+DOWNLOAD_TIMEOUT = 60
+GEOCODE_CACHE = os.path.join(CACHE_DIR, 'geocode')
+CALLBACK_CACHE = os.path.join(CACHE_DIR, 'callbacks')
+GEOCODE_WORKERS = 10
+
+# googlemaps.Client keeps a single requests.Session, so every geocode
+# call reuses the same keep-alive connection pool
 gmaps = googlemaps.Client(key=GEOCODE_API_KEY)
+geocode_cache_lock = threading.Lock()
+# one pool shared by all callbacks bounds the number of concurrent
+# geocoder requests across users, and its threads are reused
+geocode_executor = ThreadPoolExecutor(max_workers=GEOCODE_WORKERS,
+                                      thread_name_prefix='geocode')
+os.makedirs(CACHE_DIR, exist_ok=True)
 
 logger = logging.getLogger('__main__')
 
 
-def read_data_set():
+def download_data_set():
     """ Download the DOHMH New York City Restaurant Inspection Results
+        to the local cache, unless the cached copy is still current
+
+        Returns
+        -------
+        bool
+            True if a new copy of the data set was downloaded
+    """
+    request = urllib.request.Request(URL)
+    if os.path.exists(DATA_FILE) and os.path.exists(ETAG_FILE):
+        with open(ETAG_FILE) as f:
+            request.add_header('If-None-Match', f.read().strip())
+
+    try:
+        with urllib.request.urlopen(request,
+                                    timeout=DOWNLOAD_TIMEOUT) as response:
+            partial_file = DATA_FILE + '.part'
+            with open(partial_file, 'wb') as f:
+                shutil.copyfileobj(response, f)
+            # a connection dropped mid-body is not always an error,
+            # read() can just return fewer bytes
+            expected_size = response.headers.get('Content-Length')
+            size = os.path.getsize(partial_file)
+            if expected_size is not None and size != int(expected_size):
+                raise http.client.HTTPException(
+                    f'download incomplete, got {size} of '
+                    f'{expected_size} bytes')
+            os.replace(partial_file, DATA_FILE)
+            etag = response.headers.get('ETag')
+    # HTTP errors, unreachable portal and timeouts are all OSErrors,
+    # a truncated response body is an HTTPException
+    except (OSError, http.client.HTTPException) as e:
+        if isinstance(e, urllib.error.HTTPError) and e.code == 304:
+            logger.info('cached data set is up to date')
+            return False
+        if not os.path.exists(DATA_FILE):
+            raise
+        logger.warning(f'could not download data set ({e}), '
+                       'using cached copy')
+        return False
+
+    if etag:
+        with open(ETAG_FILE, 'w') as f:
+            f.write(etag)
+    elif os.path.exists(ETAG_FILE):
+        os.remove(ETAG_FILE)
+    logger.info('downloaded new copy of data set')
+    return True
+
+
+def parse_data_set():
+    """ Parse the cached csv of NYC restaurant inspection results
+
+        Returns
+        -------
+        df: DataFrame
+            dataframe containing NYC restaurant inspection results
+    """
+    # pyarrow parses the csv in parallel across all cores
+    table = pacsv.read_csv(
+        DATA_FILE,
+        read_options=pacsv.ReadOptions(use_threads=True),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=COLUMNS,
+            column_types=COLUMN_TYPES,
+            timestamp_parsers=['%m/%d/%Y'],
+            strings_can_be_null=True))
+    return table.to_pandas()
+
+
+def parquet_is_current():
+    """ Check the parquet copy of the data set can be used in place
+        of parsing the csv
+
+        Returns
+        -------
+        bool
+    """
+    if not os.path.exists(PARQUET_FILE):
+        return False
+    if os.path.getmtime(PARQUET_FILE) < os.path.getmtime(DATA_FILE):
+        return False
+    try:
+        schema = pq.read_schema(PARQUET_FILE)
+    except (pa.ArrowException, OSError) as e:
+        logger.warning(f'could not read parquet copy ({e}), rebuilding it')
+        return False
+    return set(COLUMNS) <= set(schema.names)
+
+
+def read_data_set():
+    """ Load the DOHMH New York City Restaurant Inspection Results
+
+        The csv is only parsed when a new copy has been downloaded,
+        otherwise the data set is read from a typed parquet copy
 
         Returns
         -------
@@ -31,18 +168,31 @@ def read_data_set():
             dataframe containing NYC restaurant inspection results
         cuisines: array
             list of all cuisine types in the data set
+        refreshed: bool
+            True if the data set changed since it was last loaded
     """
-    with urllib.request.urlopen(URL) as response:
-        df = pd.read_csv(response)
-    cuisines = df['CUISINE DESCRIPTION'].unique()
-    return df, cuisines
+    refreshed = download_data_set() or not parquet_is_current()
+    if refreshed:
+        df = parse_data_set()
+        # write to a temporary file so an interrupted write cannot
+        # leave a truncated parquet copy behind
+        partial_file = PARQUET_FILE + '.part'
+        df.to_parquet(partial_file, engine='pyarrow', compression='snappy')
+        os.replace(partial_file, PARQUET_FILE)
+    else:
+        df = pd.read_parquet(PARQUET_FILE, engine='pyarrow',
+                             columns=COLUMNS, memory_map=True)
+    # some restaurants have no zipcode, so use a nullable integer
+    df['ZIPCODE'] = df['ZIPCODE'].astype('Int32')
+    cuisines = df['CUISINE DESCRIPTION'].cat.categories
+    return df, cuisines, refreshed
 
 
 # ideally this would be called on server start
 # there would also be a background job to
 # periodically download a new copy of the
 # data file
-DF, CUISINES = read_data_set()
+DF, CUISINES, DATA_REFRESHED = read_data_set()
 
 
 def get_dropdown_labels(cuisines):
@@ -55,78 +205,130 @@ def get_dropdown_labels(cuisines):
 
         Returns
         -------
-        list of dict
+        tuple of dict
+            sorted by cuisine
     """
-    return [{'label': cuisine, 'value': cuisine}
-            for cuisine in cuisines]
+    return tuple({'label': cuisine, 'value': cuisine}
+                 for cuisine in sorted(cuisines))
+
+
+# the cuisines are fixed once the data set is loaded
+DROPDOWN_OPTIONS = get_dropdown_labels(CUISINES)
 
 
-def get_top_N(restos, cuisine_type='Thai', N=10):
-    """ Return the top {N} cleanest {cuisine_type}
-        restaurants
+def get_top_N_by_cuisine(restos, N=10):
+    """ Return the top {N} cleanest restaurants of every
+        cuisine type
 
         Parameters
         ----------
         restos: DataFrame
             contains NYC restaurant inspection results
-        cuisine_type: str
-            type of cuisine to search for
         N: int
-            top N restaurants to return
+            top N restaurants to return per cuisine
 
         Returns
         -------
-        top_ten: DataFrame
-            restos filtered for top {N} cleanest {cuisine_type}
-            restaurants
+        top_N: dict of DataFrame
+            restos filtered for top {N} cleanest restaurants,
+            keyed by cuisine type
     """
-    candidates = (restos
-                  .loc[((restos.GRADE == 'A') | (restos.GRADE == 'B')) &
-                       (restos['CUISINE DESCRIPTION'] == cuisine_type)]
-                  .sort_values(by='GRADE DATE', ascending=False)
-                  # only keep most recent grading
-                  .drop_duplicates(subset=['CAMIS'], keep='first')
-                  )
-    top_ten = (candidates
-               .sort_values(by='SCORE', ascending=True)
-               .iloc[:N]
-               )
-    return top_ten
-
-
-def create_full_address(resto):
+    candidates = restos.loc[restos['GRADE'].isin(['A', 'B']) &
+                            restos['GRADE DATE'].notna()]
+    # only keep most recent grading of each restaurant, for all
+    # cuisines in one pass over the data set
+    latest = (candidates
+              .groupby(['CUISINE DESCRIPTION', 'CAMIS'],
+                       sort=False, observed=True)['GRADE DATE']
+              .idxmax())
+    # restaurants whose latest grading has no score are left out
+    ranked = (candidates
+              .loc[latest]
+              .dropna(subset=['SCORE'])
+              .sort_values(by='SCORE', kind='mergesort'))
+    top_N = (ranked
+             .groupby('CUISINE DESCRIPTION', sort=False, observed=True)
+             .head(N))
+
+    by_cuisine = dict(tuple(top_N.groupby('CUISINE DESCRIPTION',
+                                          observed=True)))
+    return {cuisine: by_cuisine.get(cuisine, top_N.iloc[:0])
+            for cuisine in restos['CUISINE DESCRIPTION'].cat.categories}
+
+
+# the top {N} list only depends on the data set, so compute it once
+# for every cuisine rather than on every callback
+TOP_N_BY_CUISINE = get_top_N_by_cuisine(DF)
+
+
+def create_full_address(restos):
     """ Convert restaurant address data in different columns
         into a single string containing the address
 
         Parameters
         ----------
-        resto: Series
-            row of dataframe containing NYC restaurant inspection results
+        restos: DataFrame
+            contains NYC restaurant inspection results
 
         Returns
         -------
+        addresses: Series of str
+            full address of each restaurant as single string
+    """
+    addresses = (restos['BUILDING'].astype(str) + ' ' +
+                 restos['STREET'].astype(str) + ', ' +
+                 restos['BORO'].astype(str) + ' ' +
+                 restos['ZIPCODE'].astype(str))
+    return addresses
+
+
+@functools.lru_cache(maxsize=50000)
+def get_cached_location(address):
+    """ Look up the lat, lon of an address that has already been
+        geocoded, without querying the geocoder
+
+        Parameters
+        ----------
         address: str
             full address as single string
+
+        Returns
+        -------
+        tuple
+            lat, lon of the address, NaN if it could not be found
+
+        Raises
+        ------
+        KeyError
+            if the address has not been geocoded yet. Misses are not
+            kept by lru_cache, so later lookups see new results
     """
-    address = (f"{resto['BUILDING']} {resto['STREET']}, "
-               f"{resto['BORO']} {int(resto['ZIPCODE'])}")
-    return address
+    key = hashlib.sha1(address.encode('utf-8')).hexdigest()
+    with geocode_cache_lock, shelve.open(GEOCODE_CACHE) as cache:
+        return cache[key]
 
 
-def get_lat_lon(resto):
-    """ Retrieve lat, lon of restaurant address
+def geocode_address(address):
+    """ Retrieve lat, lon of an address
+
+        Results are kept in memory and persisted to disk, so each
+        address is only ever sent to the geocoder once
 
         Parameters
         ----------
-        resto: Series
-            row of dataframe containing NYC restaurant inspection results
+        address: str
+            full address as single string
 
         Returns
         -------
-        dict
-            containing name of restaurant and lat, lon location
+        tuple
+            lat, lon of the address, NaN if it could not be found
     """
-    address = create_full_address(resto)
+    try:
+        return get_cached_location(address)
+    except KeyError:
+        pass
+
     logger.info(f'querying for address {address}')
     results = gmaps.geocode(address)
 
@@ -134,14 +336,14 @@ def get_lat_lon(resto):
         lat = results[0].get('geometry', {}).get('location', {}).get('lat')
         lon = results[0].get('geometry', {}).get('location', {}).get('lng')
         logger.info(f'lat, lon = {lat}, {lon}')
-        return {'name': resto['DBA'],
-                'lat': lat,
-                'lon': lon}
     else:
-        logger.info(f'no results returned for {resto["DBA"]}')
-        return {'name': resto['DBA'],
-                'lat': np.nan,
-                'lon': np.nan}
+        logger.info(f'no results returned for {address}')
+        lat, lon = np.nan, np.nan
+
+    key = hashlib.sha1(address.encode('utf-8')).hexdigest()
+    with geocode_cache_lock, shelve.open(GEOCODE_CACHE) as cache:
+        cache[key] = (lat, lon)
+    return lat, lon
 
 
 def find_lat_lon(top_ten):
@@ -156,75 +358,105 @@ def find_lat_lon(top_ten):
 
         Returns
         -------
-        lat_lons: Series of dict
+        lat_lons: dict of array
             name, lat, lon of each restaurant in the top_ten
             dataframe
     """
-    lat_lons = top_ten[
-        ADDRESS_COLUMNS
-        ].apply(get_lat_lon, axis=1)
+    # the data set has coordinates for most restaurants, with missing
+    # ones recorded as 0, so only geocode the rest. Addresses without
+    # a zipcode are too incomplete to be worth querying for
+    locations = (top_ten[['Latitude', 'Longitude']]
+                 .replace(0, np.nan)
+                 .values
+                 .astype(float))
+    missing = (np.isnan(locations).any(axis=1) &
+               top_ten['ZIPCODE'].notna().values)
+
+    if missing.any():
+        addresses = create_full_address(top_ten[missing]).tolist()
+        geocoded = {}
+        for address in addresses:
+            try:
+                geocoded[address] = get_cached_location(address)
+            except KeyError:
+                pass
+
+        # geocoding is I/O bound, so query the uncached addresses
+        # concurrently. Cached ones never wait behind them in the pool
+        uncached = [address for address in dict.fromkeys(addresses)
+                    if address not in geocoded]
+        geocoded.update(zip(uncached,
+                            geocode_executor.map(geocode_address, uncached)))
+        locations[missing] = np.array([geocoded[address]
+                                       for address in addresses],
+                                      dtype=float)
+
+    lat_lons = {'name': top_ten['DBA'].values,
+                'lat': locations[:, 0],
+                'lon': locations[:, 1]}
     return lat_lons
 
 
-def plot_map(restos, cuisine_type='Thai'):
-    """ Visualise restaurants on a map of NYC
-
-        Parameters
-        ----------
-        restos: DataFrame
-            contains NYC restaurant inspection results
-        cuisine_type: str
-            type of cuisine to search for
-
-        Returns
-        -------
-        fig : plotly.Figure
-    """
-    top_ten = get_top_N(restos, cuisine_type=cuisine_type)
-    lat_lons = find_lat_lon(top_ten)
+NYC_CENTRAL_LAT = 40.7128
+NYC_CENTRAL_LON = -73.9
 
-    nyc_central_lat = 40.7128
-    nyc_central_lon = -73.9
-
-    data = [
-        Scattermapbox(
-            lon=[lat_lon['lon'] for lat_lon in lat_lons.values],
-            lat=[lat_lon['lat'] for lat_lon in lat_lons.values],
-            text=[lat_lon['name'] for lat_lon in lat_lons.values],
-            mode='markers+text',
-            showlegend=False,
-            hoverinfo='text',
-            textposition='top center',
-            marker=dict(symbol='star',
-                        size=10),
-        )
-    ]
-
-    layers = [dict(sourcetype='geojson',
-                   type='fill',
-                   color='rgba(163,22,19,0.8)'
-                   )
-              ]
-
-    layout = Layout(title='',
+# only the markers change between maps, so the layout is validated
+# once and kept as a plain dict. A Layout object would be copied and
+# revalidated by every Figure built from it
+MAP_LAYOUT = Layout(title='',
                     height=800,
                     width=600,
                     autosize=True,
                     hovermode='closest',
-                    mapbox=dict(layers=layers,
+                    mapbox=dict(layers=[dict(sourcetype='geojson',
+                                             type='fill',
+                                             color='rgba(163,22,19,0.8)'
+                                             )
+                                        ],
                                 accesstoken=MAPBOX_ACCESS_TOKEN,
                                 bearing=0,
-                                center=dict(lat=nyc_central_lat,
-                                            lon=nyc_central_lon),
+                                center=dict(lat=NYC_CENTRAL_LAT,
+                                            lon=NYC_CENTRAL_LON),
                                 pitch=0,
                                 zoom=10,
                                 style='light'
                                 ),
-                    )
+                    ).to_plotly_json()
+
+
+def plot_map(top_ten):
+    """ Visualise restaurants on a map of NYC
 
-    fig = Figure(layout=layout, data=data)
-    iplot(fig, validate=False)
+        Parameters
+        ----------
+        top_ten: DataFrame
+            contains NYC restaurant inspection results
+            for top ten cleanest restaurants
 
+        Returns
+        -------
+        fig : dict
+            plotly figure of the restaurant markers on MAP_LAYOUT
+    """
+    lat_lons = find_lat_lon(top_ten)
+    # drop restaurants the geocoder could not find
+    found = ~np.isnan(lat_lons['lat'])
+
+    marker_trace = Scattermapbox(
+        lon=lat_lons['lon'][found],
+        lat=lat_lons['lat'][found],
+        text=lat_lons['name'][found],
+        mode='markers+text',
+        showlegend=False,
+        hoverinfo='text',
+        textposition='top center',
+        marker=dict(symbol='star',
+                    size=10),
+    )
+
+    # dcc.Graph accepts plain dicts, which skips building a Figure
+    fig = {'data': [marker_trace.to_plotly_json()],
+           'layout': MAP_LAYOUT}
     return fig
 
 
@@ -243,15 +475,16 @@ def generate_table(dataframe, max_rows=10):
         html.Table
     """
     return html.Table(
-        id='output-table',
         children=
         # Header
         [html.Tr([html.Th(col) for col in dataframe.columns])] +
 
-        # Body
-        [html.Tr([
-            html.Td(dataframe.iloc[i][col]) for col in dataframe.columns
-        ]) for i in range(min(len(dataframe), max_rows))]
+        # Body, with missing values such as pd.NA zipcodes shown empty
+        # as they cannot be serialised to JSON
+        [html.Tr([html.Td(None if pd.isna(value) else value)
+                  for value in row])
+         for row in dataframe.iloc[:max_rows].itertuples(index=False,
+                                                         name=None)]
     )
 
 
@@ -259,6 +492,15 @@ external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
+# callback outputs only depend on the selected cuisine, so keep them
+# on disk where they also survive a restart of the app
+cache = Cache(app.server, config={'CACHE_TYPE': 'filesystem',
+                                  'CACHE_DIR': CALLBACK_CACHE,
+                                  'CACHE_DEFAULT_TIMEOUT': 3600})
+# outputs cached before a restart are stale once new data is loaded
+if DATA_REFRESHED:
+    cache.clear()
+
 colors = {
     'background': '#111111',
     'text': '#7FDBFF'
@@ -272,7 +514,7 @@ app.layout = html.Div(children=[
 
     dcc.Dropdown(
         id='cuisine-dropdown',
-        options=get_dropdown_labels(CUISINES),
+        options=DROPDOWN_OPTIONS,
         value='Thai'
     ), html.Div(id='output-container'),
 
@@ -282,37 +524,29 @@ app.layout = html.Div(children=[
 
     html.H4(id='output-title'),
 
-    generate_table(get_top_N(DF)[ADDRESS_COLUMNS]),
+    html.Div(id='output-table',
+             children=generate_table(
+                 TOP_N_BY_CUISINE['Thai'][ADDRESS_COLUMNS])),
 
 ])
 
 
 @app.callback(
-    dash.dependencies.Output('output-container', 'children'),
-    [dash.dependencies.Input('cuisine-dropdown', 'value')])
-def print_selection(value):
-    return f'You have selected "{value}" restaurants'
-
-
-@app.callback(
-    dash.dependencies.Output('restaurant-map', 'figure'),
-    [dash.dependencies.Input('cuisine-dropdown', 'value')])
-def plot_selection(value):
-    return plot_map(DF, cuisine_type=value)
-
-
-@app.callback(
-    dash.dependencies.Output('output-title', 'children'),
-    [dash.dependencies.Input('cuisine-dropdown', 'value')])
-def print_selection(value):
-    return f'Top Ten cleanest {value} restaurants'
-
-
-@app.callback(
-    dash.dependencies.Output('output-table', 'children'),
+    [dash.dependencies.Output('output-container', 'children'),
+     dash.dependencies.Output('restaurant-map', 'figure'),
+     dash.dependencies.Output('output-title', 'children'),
+     dash.dependencies.Output('output-table', 'children')],
     [dash.dependencies.Input('cuisine-dropdown', 'value')])
-def print_table(value):
-    return generate_table(get_top_N(DF, cuisine_type=value)[ADDRESS_COLUMNS])
+@cache.memoize()
+def update_selection(value):
+    if value is None:
+        # the dropdown has been cleared, keep showing the last selection
+        raise dash.exceptions.PreventUpdate
+    top_ten = TOP_N_BY_CUISINE[value]
+    return (f'You have selected "{value}" restaurants',
+            plot_map(top_ten),
+            f'Top Ten cleanest {value} restaurants',
+            generate_table(top_ten[ADDRESS_COLUMNS]))
 
 
 if __name__ == '__main__':